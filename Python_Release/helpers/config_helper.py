@@ -13,7 +13,15 @@ from __future__ import annotations
 # =========================
 import os
 import json
-from typing import Dict, Set, Any
+from enum import IntEnum
+from typing import Dict, Set, Any, Callable, FrozenSet, Optional
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
 
 from helpers.shell_helper import tailscale_ip4_self
 from helpers.userid_helper import userid_from_whois_json, userid_from_status_by_ip
@@ -26,25 +34,86 @@ def expand(path: str) -> str:
     return os.path.expanduser(path) if path else path
 
 
+# --- atomic_write_json() ---
+def atomic_write_json(path: str, obj: Any) -> bool:
+    """
+        Write obj as indented JSON via temp file + fsync + os.replace,
+        so a crash mid-write never leaves a truncated config behind.
+        Skips the write if the file already holds identical bytes.
+        Returns True if the file was (re)written.
+    """
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(obj, indent=2).encode("utf-8")
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+    return True
+
+
 # --- parse_modes() ---
-def parse_modes(env_val: str) -> Set[str]:
-    """Parse VALID_MODES env var (comma-separated) into an uppercased set."""
-    modes: Set[str] = set()
-    for p in (env_val or "").split(","):
-        p = p.strip()
-        if p:
-            modes.add(p.upper())
-    return modes
+_DEFAULT_MODES: FrozenSet[str] = frozenset({"EVERYONE", "CONTACTS_ONLY", "OFF", "PERSONAL"})
+
+def parse_modes(env_val: str | None) -> Set[str]:
+    """
+        Parse VALID_MODES env var (comma-separated) into an uppercased set.
+        Empty/unset (or only blanks) → the default mode set.
+    """
+    if not env_val:
+        return set(_DEFAULT_MODES)
+    modes = {p.strip().upper() for p in env_val.split(",") if p.strip()}
+    return modes or set(_DEFAULT_MODES)
+
+
+# --- Mode ---
+class Mode(IntEnum):
+    """Sharing modes; resolved once per config load (unknown names → OFF)."""
+    OFF = 0
+    PERSONAL = 1  # hidden mode
+    CONTACTS_ONLY = 2
+    EVERYONE = 3
+
+
+# --- build_allow_fn() ---
+def build_allow_fn(mode: Mode, personal_uid: int, contacts: FrozenSet[int]) -> Callable[[Optional[int]], bool]:
+    """
+        Pre-build the sender allow-predicate for a mode, closing over
+        personal_uid/contacts so per-request checks are a single call.
+    """
+    table: Dict[Mode, Callable[[Optional[int]], bool]] = {
+        Mode.OFF:           lambda uid: False,
+        Mode.EVERYONE:      lambda uid: True,
+        Mode.CONTACTS_ONLY: lambda uid: uid is not None and (uid == personal_uid or uid in contacts),
+        Mode.PERSONAL:      lambda uid: uid is not None and uid == personal_uid,
+    }
+    return table[mode]
 
 
 # --- load_or_init_config() ---
-def load_or_init_config(env: Dict[str, str], valid_modes_env: str) -> Dict[str, Any]:
+def load_or_init_config(env: Dict[str, str], valid_modes: Set[str]) -> Dict[str, Any]:
     """
         Load ~/.config/Spacedrop/config.json if present; else create default:
           mode="PERSONAL"
           personal_user_id = whois(self IPv4)
           contacts_user_ids = []
-        Returns a config dict with normalized values and
+        valid_modes is the parsed VALID_MODES set (see parse_modes()).
+        Returns a config dict with normalized values,
+        _mode_enum/_contacts_set/_allow_fn (pre-built sender check) and
         _conf_dir/_conf_path for server reference.
     """
     conf_dir  = expand(env.get("CONF_DIR", "~/.config/Spacedrop"))
@@ -52,8 +121,8 @@ def load_or_init_config(env: Dict[str, str], valid_modes_env: str) -> Dict[str,
     os.makedirs(conf_dir, exist_ok=True)
 
     if os.path.isfile(conf_path):
-        with open(conf_path, "r") as f:
-            cfg = json.load(f)
+        with open(conf_path, "rb") as f:
+            cfg = json_loads(f.read())
     else:
         personal_uid = 0
         ip4 = tailscale_ip4_self()
@@ -66,22 +135,31 @@ def load_or_init_config(env: Dict[str, str], valid_modes_env: str) -> Dict[str,
             "personal_user_id": personal_uid,
             "contacts_user_ids": []
         }
-        with open(conf_path, "w") as f:
-            json.dump(cfg, f, indent=2)
+        atomic_write_json(conf_path, cfg)
 
-    valid_modes = parse_modes(valid_modes_env) or {"EVERYONE","CONTACTS_ONLY","OFF","PERSONAL"}
     mode = str(cfg.get("mode", "PERSONAL")).upper()
     if mode not in valid_modes:
         mode = "PERSONAL"
     cfg["mode"] = mode
 
     def _as_int(x):
+        if type(x) is int:  # common case for JSON-loaded ids; bools still go through int()
+            return x
         try: return int(x)
         except Exception: return 0
 
     cfg["personal_user_id"] = _as_int(cfg.get("personal_user_id"))
     ids = cfg.get("contacts_user_ids") or []
-    cfg["contacts_user_ids"] = sorted({ _as_int(v) for v in ids if _as_int(v) })
+    out: Set[int] = set()
+    for v in ids:
+        i = _as_int(v)
+        if i:
+            out.add(i)
+    cfg["contacts_user_ids"] = sorted(out)
+
+    cfg["_contacts_set"] = frozenset(cfg["contacts_user_ids"])
+    cfg["_mode_enum"] = Mode.__members__.get(mode, Mode.OFF)
+    cfg["_allow_fn"] = build_allow_fn(cfg["_mode_enum"], cfg["personal_user_id"], cfg["_contacts_set"])
 
     cfg["_conf_dir"] = conf_dir
     cfg["_conf_path"] = conf_path
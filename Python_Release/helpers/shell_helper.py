@@ -15,11 +15,12 @@ from __future__ import annotations
 # =========================
 import os
 import re
+import asyncio
 import shutil
+import functools
 import subprocess
-import ipaddress
 from urllib.parse import urlparse
-from typing import List, Optional
+from typing import List, Optional, Tuple
 # =========================
 
 
@@ -32,12 +33,66 @@ def run(cmd: List[str]) -> str:
     return subprocess.check_output(cmd, text=True).strip()
 
 
+# --- run_bytes() ---
+def run_bytes(cmd: List[str]) -> bytes:
+    """
+        Same as run(), but returns raw stdout bytes
+        (skips the utf-8 decode for JSON parsers).
+    """
+    return subprocess.check_output(cmd).strip()
+
+
+# --- run_bytes_async() ---
+async def run_bytes_async(cmd: List[str], timeout: Optional[float] = None) -> bytes:
+    """
+        Async counterpart of run_bytes(): does not block the event loop.
+        Raises CalledProcessError on failure, TimeoutError on timeout.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out.strip()
+
+
 # --- expand() ---
 def expand(path: str | None) -> str | None:
     """Expand ~ in the given path (or return None if path is None)."""
     return os.path.expanduser(path) if path else path
 
 
+# AppleScript string-literal escaping (backslashes and double-quotes)
+_AS_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"'})
+
+def _as_esc(s: str) -> str:
+    return s.translate(_AS_ESCAPES)
+
+
+# Resolved once: $PATH lookups are not repeated per notification
+_TN_PATH = shutil.which("terminal-notifier")
+
+
+# --- _icon_file() ---
+@functools.lru_cache(maxsize=16)
+def _icon_file(icon_path: str | None) -> Optional[str]:
+    """Expanded icon path if it exists on disk, else None (memoized)."""
+    icon = expand(icon_path) if icon_path else None
+    return icon if icon and os.path.exists(icon) else None
+
+
+# --- refresh_icon_cache() ---
+def refresh_icon_cache() -> None:
+    """Forget memoized icon existence (e.g. ICON_PATH created after startup)."""
+    _icon_file.cache_clear()
+
+
 # --- notify() ---
 def notify(title: str, text: str, icon_path: Optional[str] = None) -> None:
     """
@@ -49,12 +104,12 @@ def notify(title: str, text: str, icon_path: Optional[str] = None) -> None:
             - icon_path (Optional[str]): Path to PNG/ICNS icon (optional)
     """
     try:
-        tn = shutil.which("terminal-notifier")
-        icon = expand(icon_path) if icon_path else None
+        tn = _TN_PATH
+        icon = _icon_file(icon_path)
 
         if tn:
             cmd = [tn, "-title", title, "-message", text]
-            if icon and os.path.exists(icon):
+            if icon:
                 cmd += ["-appIcon", icon]
             subprocess.run(cmd, check=False)
             return
@@ -62,13 +117,77 @@ def notify(title: str, text: str, icon_path: Optional[str] = None) -> None:
         # Fallback: AppleScript (no custom icon support)
         subprocess.run([
             "osascript", "-e",
-            f'display notification "{text.replace("\\","\\\\").replace("\"","\\\"")}" with title "{title}"'
+            f'display notification "{_as_esc(text)}" with title "{_as_esc(title)}"'
         ], check=False)
     except Exception:
         # Non-fatal: notifications should not crash the server
         pass
 
 
+# Dialog scripts return "accept" or "decline"; {giveup} is the optional timeout clause
+_CONFIRM_TMPL_NOICON = '''set theButtons to {{"Decline","Accept"}}
+set theTitle to "{title}"
+set theText to "{text}"
+set timeoutSeconds to {tsec}
+try
+  display dialog theText with title theTitle buttons theButtons default button "Accept"{giveup}
+  set btn to button returned of result
+  set gu to false
+  try
+    set gu to gave up of result
+  end try
+on error
+  return "decline"
+end try
+if gu then return "decline"
+if btn is "Accept" then return "accept"
+return "decline"
+'''
+
+_CONFIRM_TMPL_ICON = '''set theButtons to {{"Decline","Accept"}}
+set theTitle to "{title}"
+set theText to "{text}"
+set timeoutSeconds to {tsec}
+set theIcon to POSIX file "{icon}"
+try
+  display dialog theText with title theTitle buttons theButtons default button "Accept" with icon theIcon{giveup}
+  set btn to button returned of result
+  set gu to false
+  try
+    set gu to gave up of result
+  end try
+on error
+  return "decline"
+end try
+if gu then return "decline"
+if btn is "Accept" then return "accept"
+return "decline"
+'''
+
+
+# --- probe_gui_session() ---
+def probe_gui_session() -> bool:
+    """
+        (Re)detect whether the current user has a GUI (Aqua) login session,
+        i.e. whether an AppleScript dialog can be shown at all.
+        Run once at server startup (off the event loop) and again after the
+        user logs in; confirm() only probes itself if that never happened.
+    """
+    global _HAS_GUI
+    try:
+        r = subprocess.run(["launchctl", "print", f"gui/{os.getuid()}"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=2)
+        _HAS_GUI = r.returncode == 0
+    except FileNotFoundError:
+        _HAS_GUI = False  # not macOS: no osascript either
+    except Exception:
+        _HAS_GUI = True   # can't tell; keep the dialog path
+    return _HAS_GUI
+
+
+_HAS_GUI: Optional[bool] = None  # unknown until probed
+
+
 # --- confirm() ---
 def confirm(title: str, text: str, icon_path: Optional[str] = None, timeout_sec: int = 20) -> bool:
     """
@@ -77,50 +196,20 @@ def confirm(title: str, text: str, icon_path: Optional[str] = None, timeout_sec:
         Notes:
           • timeout_sec=0 means "no timeout".
           • Supports custom icon (PNG/ICNS) when provided.
+          • Declines immediately when no GUI session is attached
+            (instead of blocking on osascript until it errors).
     """
-    icon = expand(icon_path) if icon_path else None
-
-    def esc(s: str) -> str:
-        # Escape backslashes and double-quotes for AppleScript string literals
-        return s.replace("\\", "\\\\").replace("\"", "\\\"")
-
+    if not (probe_gui_session() if _HAS_GUI is None else _HAS_GUI):
+        return False
+    icon = _icon_file(icon_path)
     tsec = max(0, int(timeout_sec))
-    lines: List[str] = []
-    lines.append('set theButtons to {"Decline","Accept"}')
-    lines.append(f'set theTitle to "{esc(title)}"')
-    lines.append(f'set theText to "{esc(text)}"')
-    lines.append(f'set timeoutSeconds to {tsec}')
-
-    if icon and os.path.exists(icon):
-        lines.append(f'set theIcon to POSIX file "{esc(icon)}"')
-
-    # Build a robust dialog call
-    lines.append('try')
-    if icon and os.path.exists(icon):
-        if tsec > 0:
-            lines.append('  display dialog theText with title theTitle buttons theButtons default button "Accept" with icon theIcon giving up after timeoutSeconds')
-        else:
-            lines.append('  display dialog theText with title theTitle buttons theButtons default button "Accept" with icon theIcon')
+    giveup = " giving up after timeoutSeconds" if tsec > 0 else ""
+    if icon:
+        script = _CONFIRM_TMPL_ICON.format(title=_as_esc(title), text=_as_esc(text),
+                                           tsec=tsec, icon=_as_esc(icon), giveup=giveup)
     else:
-        if tsec > 0:
-            lines.append('  display dialog theText with title theTitle buttons theButtons default button "Accept" giving up after timeoutSeconds')
-        else:
-            lines.append('  display dialog theText with title theTitle buttons theButtons default button "Accept"')
-
-    lines.append('  set btn to button returned of result')
-    lines.append('  set gu to false')
-    lines.append('  try')
-    lines.append('    set gu to gave up of result')
-    lines.append('  end try')
-    lines.append('on error')
-    lines.append('  return "decline"')
-    lines.append('end try')
-
-    lines.append('if gu then return "decline"')
-    lines.append('if btn is "Accept" then return "accept"')
-    lines.append('return "decline"')
-
-    script = "\n".join(lines)
+        script = _CONFIRM_TMPL_NOICON.format(title=_as_esc(title), text=_as_esc(text),
+                                             tsec=tsec, giveup=giveup)
 
     try:
         out = subprocess.check_output(["osascript", "-e", script], text=True).strip()
@@ -131,18 +220,23 @@ def confirm(title: str, text: str, icon_path: Optional[str] = None, timeout_sec:
 
 # --- URL helpers (NEW) ---
 _URL_RE = re.compile(r'^(https?://\S+)$', re.IGNORECASE)
+# Share-sheet HTML carries its link near the top; only this much is scanned.
+# Quantifiers are bounded so crafted HTML cannot trigger runaway backtracking.
+HTML_SCAN_LIMIT = 32 * 1024
+_META_REFRESH_RE = re.compile(r'http-equiv=["\']refresh["\'].{0,512}?url=([^"\'> ]{1,2048})', re.I)
+_ANCHOR_RE = re.compile(r'<a[^>]{0,512}href=["\']([^"\']{1,2048})["\']', re.I)
 
 def is_http_url(s: str | None) -> Optional[str]:
     """Return normalized http(s) URL if valid, else None."""
     if not s:
         return None
     s = s.strip()
+    # cheap prefix gate rejects plain text before any regex/urlparse work
+    if not s[:8].lower().startswith(("http://", "https://")):
+        return None
     if not _URL_RE.match(s):
         return None
-    p = urlparse(s)
-    if p.scheme in ("http", "https") and p.netloc:
-        return s
-    return None
+    return s if urlparse(s).netloc else None
 
 def extract_url_from_html(html_text: str | None) -> Optional[str]:
     """
@@ -150,17 +244,19 @@ def extract_url_from_html(html_text: str | None) -> Optional[str]:
     Supports:
       - <meta http-equiv="refresh" content="0; url=...">
       - A single <a href="..."> link
+    Only the first HTML_SCAN_LIMIT characters are searched.
     """
     if not html_text:
         return None
+    html_text = html_text[:HTML_SCAN_LIMIT]
     # meta refresh
-    m = re.search(r'http-equiv=["\']refresh["\'].*?url=([^"\'> ]+)', html_text, re.I)
+    m = _META_REFRESH_RE.search(html_text)
     if m:
         url = is_http_url(m.group(1))
         if url:
             return url
     # anchor tag
-    m = re.search(r'<a[^>]+href=["\']([^"\']+)["\']', html_text, re.I)
+    m = _ANCHOR_RE.search(html_text)
     if m:
         url = is_http_url(m.group(1))
         if url:
@@ -191,6 +287,9 @@ def open_url(url: str) -> bool:
 
 
 # --- tailscale_ip4_self() ---
+# `tailscale ip -4` already prints only IPv4s; this is just a cheap sanity guard
+_IPV4_RE = re.compile(r'^(?:\d{1,3}\.){3}\d{1,3}$')
+
 def tailscale_ip4_self() -> Optional[str]:
     """
         Get the first IPv4 address of the current Tailscale node.
@@ -200,19 +299,17 @@ def tailscale_ip4_self() -> Optional[str]:
         out = run(["tailscale", "ip", "-4"])
         for line in out.splitlines():
             s = line.strip()
-            try:
-                ipaddress.IPv4Address(s)
+            if _IPV4_RE.match(s):
                 return s
-            except Exception:
-                continue
     except Exception:
         pass
     return None
 
-def unique_path(directory: str, filename: str) -> str:
+def unique_open(directory: str, filename: str) -> Tuple[int, str]:
     """
-    Return a non-conflicting path inside `directory` for `filename`.
+    Atomically create a non-conflicting file inside `directory` for `filename`.
     If the file exists, appends ' (1)', ' (2)', ... before the extension.
+    Returns (fd, path); the fd is open for writing (wrap with os.fdopen).
 
     Example:
         foo.txt -> foo.txt
@@ -220,9 +317,12 @@ def unique_path(directory: str, filename: str) -> str:
         foo (1).txt (also exists) -> foo (2).txt
     """
     base, ext = os.path.splitext(filename)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY
     candidate = os.path.join(directory, filename)
     i = 1
-    while os.path.exists(candidate):
-        candidate = os.path.join(directory, f"{base} ({i}){ext}")
-        i += 1
-    return candidate
+    while True:
+        try:
+            return os.open(candidate, flags, 0o644), candidate
+        except FileExistsError:
+            candidate = os.path.join(directory, f"{base} ({i}){ext}")
+            i += 1
@@ -6,18 +6,194 @@ from __future__ import annotations
 #
 # Description:
 #   Resolve Tailscale UserIDs from IP addresses.
+#   Results are cached for CACHE_TTL seconds to avoid spawning
+#   `tailscale` on every request.
 # License: MIT
 # =========================
 
 # Imports
 # =========================
 import json
+import time
+import asyncio
+import threading
 import ipaddress
-from typing import Optional, Dict, Any, List
-from helpers.shell_helper import run
+import subprocess
+from typing import Optional, Dict, Any, List, Tuple, Iterable, IO
+from helpers.shell_helper import run_bytes, run_bytes_async
+
+try:
+    import orjson  # faster on large `status --json` blobs
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
+try:
+    import ijson  # optional: stream `status --json` instead of parsing it whole
+except ImportError:
+    ijson = None
 # =========================
 
 
+# -------- cache --------
+CACHE_TTL = 30.0         # seconds
+STATUS_FAIL_TTL = 5.0    # seconds; a failed `status` is retried sooner
+WHOIS_TIMEOUT = 5.0      # seconds
+WHOIS_CACHE_MAX = 256    # distinct sender IPs kept
+
+_CACHE_LOCK = threading.Lock()
+_WHOIS_CACHE: Dict[str, Tuple[float, Optional[int]]] = {}  # oldest first (ts, uid)
+_STATUS_CACHE: Optional[Tuple[float, Dict[str, int]]] = None  # (expires_at, index)
+
+# Single-flight: concurrent misses wait on the spawn already running
+_STATUS_REFRESH_LOCK = threading.Lock()
+_WHOIS_INFLIGHT: Dict[str, asyncio.Future] = {}  # event-loop only
+
+
+# --- _normalize_ip() ---
+def _normalize_ip(ip: Any) -> Optional[str]:
+    """
+        Canonical string form of an IP (IPv4-mapped IPv6 → IPv4),
+        shared by cache keys and the status index. None if malformed.
+    """
+    try:
+        addr = ipaddress.ip_address(ip)
+    except (TypeError, ValueError):
+        return None
+    mapped = getattr(addr, "ipv4_mapped", None)
+    return str(mapped or addr)
+
+
+# --- _index_node() ---
+def _index_node(idx: Dict[str, int], uid: Any, ips: Iterable[Any]) -> None:
+    """Add one node's TailscaleIPs (normalized) → UserID to idx."""
+    try:
+        uid = int(uid)
+    except (TypeError, ValueError):
+        return
+    for a in ips or []:
+        key = _normalize_ip(a)
+        if key:
+            idx.setdefault(key, uid)
+
+
+# --- _build_ip_index() ---
+def _build_ip_index(st: Dict[str, Any]) -> Dict[str, int]:
+    """
+        Map every normalized TailscaleIP in a status blob (peers + Self)
+        to its node's UserID. Malformed entries are skipped here, once.
+    """
+    idx: Dict[str, int] = {}
+    nodes: List[Dict[str, Any]] = list((st.get("Peer") or {}).values())
+    if st.get("Self"):
+        nodes.append(st["Self"])
+    for node in nodes:
+        _index_node(idx, node.get("UserID"), node.get("TailscaleIPs"))
+    return idx
+
+
+# --- _build_ip_index_stream() ---
+def _build_ip_index_stream(fp: IO[bytes]) -> Dict[str, int]:
+    """
+        Same as _build_ip_index(), but streams `tailscale status --json`
+        with ijson and only keeps Self/Peer.* UserID + TailscaleIPs,
+        never materializing the rest of the tailnet state.
+    """
+    idx: Dict[str, int] = {}
+    node: Optional[str] = None  # prefix of the node being read ("Self" / "Peer.<key>")
+    uid: Any = None
+    ips: List[str] = []
+    for prefix, event, value in ijson.parse(fp):
+        if event == "start_map" and (prefix == "Self" or (prefix.startswith("Peer.") and prefix.count(".") == 1)):
+            node, uid, ips = prefix, None, []
+        elif node is None:
+            continue
+        elif event == "end_map" and prefix == node:
+            _index_node(idx, uid, ips)
+            node = None
+        elif prefix == node + ".UserID":
+            uid = value
+        elif prefix == node + ".TailscaleIPs.item":
+            ips.append(value)
+    return idx
+
+
+# --- _status_index() ---
+def _status_index() -> Dict[str, int]:
+    """
+        Return the IP → UserID index built from `tailscale status --json`,
+        rebuilt lazily once the cached copy is older than CACHE_TTL.
+        Streams the output through ijson when installed.
+        A failed run caches an empty index for STATUS_FAIL_TTL.
+        Only one refresh runs at a time; other callers wait for its result.
+    """
+    with _STATUS_REFRESH_LOCK:
+        return _status_index_locked()
+
+
+# --- _status_index_locked() ---
+def _status_index_locked() -> Dict[str, int]:
+    """_status_index() body; caller holds _STATUS_REFRESH_LOCK."""
+    global _STATUS_CACHE
+    now = time.monotonic()
+    with _CACHE_LOCK:
+        if _STATUS_CACHE and now < _STATUS_CACHE[0]:
+            return _STATUS_CACHE[1]
+    cmd = ["tailscale", "status", "--json"]
+    try:
+        if ijson is not None:
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+                idx = _build_ip_index_stream(proc.stdout)
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+        else:
+            idx = _build_ip_index(json_loads(run_bytes(cmd)))
+        expires = now + CACHE_TTL
+    except Exception:
+        idx, expires = {}, now + STATUS_FAIL_TTL
+    with _CACHE_LOCK:
+        _STATUS_CACHE = (expires, idx)
+    return idx
+
+
+# --- _whois_cached() ---
+def _whois_cached(ip: str) -> Tuple[bool, Optional[int]]:
+    """Return (hit, uid) for a fresh whois cache entry."""
+    with _CACHE_LOCK:
+        hit = _WHOIS_CACHE.get(ip)
+        if hit and time.monotonic() - hit[0] < CACHE_TTL:
+            return True, hit[1]
+    return False, None
+
+
+# --- _whois_store() ---
+def _whois_store(ip: str, out: Optional[bytes]) -> Optional[int]:
+    """
+        Parse `tailscale whois --json` output, cache and return the UserID.
+        out=None (failed/timed-out run) or unparsable output caches None too,
+        so a failing sender does not spawn `tailscale` on every request.
+    """
+    try:
+        obj = json_loads(out) if out is not None else {}
+        uid = (obj.get("UserProfile", {}).get("ID") or obj.get("Node", {}).get("User"))
+        uid = int(uid) if uid is not None else None
+    except Exception:
+        uid = None
+    now = time.monotonic()
+    with _CACHE_LOCK:
+        # re-insert so the dict stays ordered oldest → newest
+        _WHOIS_CACHE.pop(ip, None)
+        _WHOIS_CACHE[ip] = (now, uid)
+        # evict expired entries (all at the front), then cap the size
+        while _WHOIS_CACHE:
+            k, (ts, _) = next(iter(_WHOIS_CACHE.items()))
+            if now - ts < CACHE_TTL and len(_WHOIS_CACHE) <= WHOIS_CACHE_MAX:
+                break
+            del _WHOIS_CACHE[k]
+    return uid
+
+
 # --- userid_from_whois_json() ---
 def userid_from_whois_json(ip: str) -> Optional[int]:
     """
@@ -26,13 +202,42 @@ def userid_from_whois_json(ip: str) -> Optional[int]:
         - UserProfile.ID  (authoritative)
         - fallback Node.User
     """
+    hit, uid = _whois_cached(ip)
+    if hit:
+        return uid
     try:
-        out = run(["tailscale", "whois", "--json", ip])
-        obj = json.loads(out)
-        uid = (obj.get("UserProfile", {}).get("ID") or obj.get("Node", {}).get("User"))
-        return int(uid) if uid is not None else None
+        out = run_bytes(["tailscale", "whois", "--json", ip])
     except Exception:
-        return None
+        out = None
+    return _whois_store(ip, out)
+
+
+# --- userid_from_whois_json_async() ---
+async def userid_from_whois_json_async(ip: str) -> Optional[int]:
+    """
+        Same as userid_from_whois_json(), without blocking the event loop.
+        Concurrent misses for one IP share a single `tailscale whois` spawn.
+    """
+    hit, uid = _whois_cached(ip)
+    if hit:
+        return uid
+    pending = _WHOIS_INFLIGHT.get(ip)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    fut = asyncio.get_running_loop().create_future()
+    _WHOIS_INFLIGHT[ip] = fut
+    try:
+        try:
+            out = await run_bytes_async(["tailscale", "whois", "--json", ip], timeout=WHOIS_TIMEOUT)
+        except Exception:
+            out = None
+        uid = _whois_store(ip, out)
+        fut.set_result(uid)
+        return uid
+    finally:
+        _WHOIS_INFLIGHT.pop(ip, None)
+        if not fut.done():  # cancelled mid-spawn: release waiters with "unknown"
+            fut.set_result(None)
 
 
 # --- userid_from_status_by_ip() ---
@@ -42,21 +247,9 @@ def userid_from_status_by_ip(ip: str) -> Optional[int]:
         then read the node's UserID.
     """
     try:
-        out = run(["tailscale", "status", "--json"])
-        st = json.loads(out)
-        peers: List[Dict[str, Any]] = list((st.get("Peer") or {}).values())
-        self_node: Dict[str, Any] = st.get("Self") or {}
-        for node in peers + ([self_node] if self_node else []):
-            for a in node.get("TailscaleIPs", []):
-                try:
-                    if ipaddress.ip_address(ip) == ipaddress.ip_address(a):
-                        uid = node.get("UserID")
-                        return int(uid) if uid is not None else None
-                except Exception:
-                    continue
+        return _status_index().get(_normalize_ip(ip) or ip)
     except Exception:
-        pass
-    return None
+        return None
 
 
 # --- sender_userid() ---
@@ -65,4 +258,30 @@ def sender_userid(src_ip: str) -> Optional[int]:
         Resolve sender's Tailscale UserID using whois JSON first,
         then fall back to status JSON.
     """
-    return userid_from_whois_json(src_ip) or userid_from_status_by_ip(src_ip)
+    ip = _normalize_ip(src_ip) or src_ip
+    return userid_from_whois_json(ip) or userid_from_status_by_ip(ip)
+
+
+# --- sender_userid_async() ---
+async def sender_userid_async(src_ip: str) -> Optional[int]:
+    """
+        Async variant of sender_userid() for FastAPI handlers.
+        Cache hits return without awaiting a subprocess.
+    """
+    ip = _normalize_ip(src_ip) or src_ip
+    uid = await userid_from_whois_json_async(ip)
+    if uid:
+        return uid
+    return await asyncio.to_thread(userid_from_status_by_ip, ip)
+
+
+# --- cache_clear() ---
+def cache_clear() -> None:
+    """Drop all cached whois/status lookups (e.g. on config reload)."""
+    global _STATUS_CACHE
+    with _CACHE_LOCK:
+        _WHOIS_CACHE.clear()
+        _STATUS_CACHE = None
+
+
+sender_userid.cache_clear = cache_clear  # type: ignore[attr-defined]
@@ -27,6 +27,7 @@ from __future__ import annotations
 # Imports
 # =========================
 import os
+import asyncio
 from datetime import datetime
 from typing import Optional, Dict, Any
 from urllib.parse import urlparse
@@ -42,10 +43,13 @@ from helpers.shell_helper import (
     open_url,
     is_http_url,
     extract_url_from_html,
-    unique_path,
+    HTML_SCAN_LIMIT,
+    unique_open,
+    probe_gui_session,
+    refresh_icon_cache,
 )
-from helpers.userid_helper import sender_userid
-from helpers.config_helper import load_or_init_config, parse_modes
+from helpers.userid_helper import sender_userid, sender_userid_async
+from helpers.config_helper import Mode, load_or_init_config, parse_modes
 # =========================
 
 
@@ -59,36 +63,35 @@ APP_TITLE = ENV.get("APP_TITLE", "Spacedrop Server (one-way)")
 DOWNLOADS_DIR = expand(ENV.get("DOWNLOADS_DIR", "~/Downloads"))
 CONF_DIR      = expand(ENV.get("CONF_DIR", "~/.config/Spacedrop"))
 CONF_PATH     = expand(ENV.get("CONF_PATH", "~/.config/Spacedrop/config.json"))
-VALID_MODES   = parse_modes(ENV.get("VALID_MODES", "EVERYONE,CONTACTS_ONLY,OFF,PERSONAL"))
+VALID_MODES   = parse_modes(ENV.get("VALID_MODES"))
 
 # Custom icon + confirmation settings
 ICON_PATH = expand(ENV.get("ICON_PATH", "~/Spacedrop/icon.png"))
 REQUIREconfirm_ON_FOREIGN = ENV.get("REQUIREconfirm_ON_FOREIGN", "1") not in ("0","false","False","no","No")
 APPROVAL_TIMEOUT = int(ENV.get("APPROVAL_TIMEOUT", "20"))
+CONFIRM_ON_SELF = ENV.get("CONFIRM_ON_SELF", "0") not in ("0", "false", "False", "no", "No")
+
+# Upload streaming (bytes)
+HEAD_SNIFF_BYTES   = 4 * 1024      # enough for .txt/.url/.webloc link wrappers
+HTML_SNIFF_BYTES   = HTML_SCAN_LIMIT  # no point reading past the extract_url_from_html() scan cap
+UPLOAD_CHUNK_BYTES = 1024 * 1024
 
 app = FastAPI(title=APP_TITLE)
 
+
+@app.on_event("startup")
+async def _probe_gui_on_startup():
+    """Detect the GUI session before serving, in a worker thread, so confirm() never probes mid-request."""
+    await asyncio.to_thread(probe_gui_session)
+
+
 # -------- config --------
-CONFIG: dict[str, Any] = load_or_init_config(ENV, ENV.get("VALID_MODES", ""))
+CONFIG: dict[str, Any] = load_or_init_config(ENV, VALID_MODES)
 
 
 def _allowed(uid: Optional[int]) -> bool:
     """Check if the user is allowed to send based on mode & IDs."""
-    mode = CONFIG["mode"]
-    personal_uid = CONFIG["personal_user_id"]
-    contacts = set(CONFIG["contacts_user_ids"])
-
-    if mode == "OFF":
-        return False
-    if mode == "EVERYONE":
-        return True
-    if uid is None:
-        return False
-    if mode == "CONTACTS_ONLY":
-        return (uid == personal_uid) or (uid in contacts)
-    if mode == "PERSONAL":  # hidden mode
-        return uid == personal_uid
-    return False
+    return CONFIG["_allow_fn"](uid)
 
 
 def _maybeconfirm(uid: Optional[int]) -> bool:
@@ -102,25 +105,17 @@ def _maybeconfirm(uid: Optional[int]) -> bool:
     if not REQUIREconfirm_ON_FOREIGN:
         return True
 
-    personal_uid = int(CONFIG.get("personal_user_id", 0) or 0)
-    mode = CONFIG.get("mode", "PERSONAL").upper()
-
-    # allow skipping confirmation for your own devices in all modes (default)
-    confirm_on_self = os.getenv("CONFIRM_ON_SELF", "0") not in ("0", "false", "False", "no", "No")
-    if uid is not None and int(uid) == personal_uid and not confirm_on_self:
-        return True
-
-    if mode == "PERSONAL" and uid is not None and int(uid) == personal_uid:
-        return True
+    # own devices skip the prompt unless CONFIRM_ON_SELF=1 (always skipped in PERSONAL)
+    if uid is not None and uid == CONFIG["personal_user_id"]:
+        if not CONFIRM_ON_SELF or CONFIG["_mode_enum"] == Mode.PERSONAL:
+            return True
 
     msg = "Unknown sender (no UserID). Accept incoming item?" if uid is None else f"Incoming item from UserID {uid}. Accept?"
     return confirm("Spacedrop", msg, ICON_PATH, APPROVAL_TIMEOUT)
 
 
-# -------- API --------
-@app.get("/health")
-def health():
-    """Check server health/configuration."""
+def _build_health() -> Dict[str, Any]:
+    """Static /health payload; only changes when the config is (re)loaded."""
     return {
         "ok": True,
         "mode": CONFIG["mode"],
@@ -134,19 +129,33 @@ def health():
     }
 
 
+_HEALTH_CACHE: Dict[str, Any] = _build_health()
+
+
+# -------- API --------
+@app.get("/health")
+async def health():
+    """Check server health/configuration."""
+    return _HEALTH_CACHE
+
+
 @app.get("/debug/whoami")
-def debug_whoami(request: Request):
+async def debug_whoami(request: Request):
     """Identify the calling peer by Tailscale UserID."""
     src_ip = request.client.host
-    uid = sender_userid(src_ip)
+    uid = await sender_userid_async(src_ip)
     return {"src_ip": src_ip, "user_id": uid}
 
 
 @app.post("/admin/reload-config")
 def reload_config():
     """Reload configuration from disk."""
-    global CONFIG
-    CONFIG = load_or_init_config(ENV, ENV.get("VALID_MODES", ""))
+    global CONFIG, _HEALTH_CACHE
+    sender_userid.cache_clear()
+    probe_gui_session()  # the user may have logged in since startup
+    refresh_icon_cache()  # ICON_PATH may have been created since
+    CONFIG = load_or_init_config(ENV, VALID_MODES)
+    _HEALTH_CACHE = _build_health()
     return {"ok": True, "mode": CONFIG["mode"], "personal_user_id": CONFIG["personal_user_id"]}
 
 
@@ -166,7 +175,7 @@ async def drop(
       - Else, save the file to Downloads (original behavior).
     """
     src_ip = request.client.host
-    uid = sender_userid(src_ip)
+    uid = await sender_userid_async(src_ip)
 
     if not _allowed(uid):
         raise HTTPException(status_code=401, detail=f"Sender not allowed (UserID={uid}) in mode {CONFIG['mode']}")
@@ -187,10 +196,12 @@ async def drop(
     if file:
         name = (file.filename or "").lower()
 
-        data = await file.read()  # need content to inspect; file sizes from share sheets are tiny
-        # Try URL wrappers first
-        if name.endswith((".txt", ".url", ".webloc")):
-            candidate = data.decode("utf-8", "ignore").strip()
+        # Only the head is needed to sniff URL wrappers; the rest is streamed to disk
+        head = await file.read(HEAD_SNIFF_BYTES)
+        # Try URL wrappers first (only if the whole file fit in the head, so a
+        # truncated URL is never opened)
+        if name.endswith((".txt", ".url", ".webloc")) and len(head) < HEAD_SNIFF_BYTES:
+            candidate = head.decode("utf-8", "ignore").strip()
             url = is_http_url(candidate)
             if url:
                 opened = open_url(url)
@@ -199,7 +210,9 @@ async def drop(
                 return JSONResponse({"ok": True, "action": "opened_url", "url": url, "opened": bool(opened)})
 
         if name.endswith((".html", ".htm")):
-            url = extract_url_from_html(data.decode("utf-8", "ignore"))
+            # meta-refresh/anchor may sit deeper than the first chunk
+            head += await file.read(HTML_SNIFF_BYTES - len(head))
+            url = extract_url_from_html(head.decode("utf-8", "ignore"))
             if url:
                 opened = open_url(url)
                 host = urlparse(url).netloc or url
@@ -209,10 +222,11 @@ async def drop(
         # Otherwise treat it as a normal file (save to Downloads)
         os.makedirs(DOWNLOADS_DIR, exist_ok=True)
         base = os.path.basename(file.filename or "untitled")
-        out_path = unique_path(DOWNLOADS_DIR, base)
-        with open(out_path, "wb") as f:
-            f.write(data)
-
+        fd, out_path = unique_open(DOWNLOADS_DIR, base)
+        with os.fdopen(fd, "wb") as f:
+            f.write(head)
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                f.write(chunk)
 
         notify("Saved to Downloads", base, icon_path=ICON_PATH)
         return JSONResponse({"ok": True, "saved_as": out_path, "mode": CONFIG["mode"], "user_id": uid})
@@ -229,7 +243,7 @@ async def clip_push(request: Request,
                     image: UploadFile = File(None)):
     """Push clipboard content from the phone to the Mac."""
     src_ip = request.client.host
-    uid = sender_userid(src_ip)
+    uid = await sender_userid_async(src_ip)
 
     if not _allowed(uid):
         raise HTTPException(status_code=401, detail=f"Sender not allowed (UserID={uid}) in mode {CONFIG['mode']}")
@@ -253,24 +267,18 @@ async def clip_push(request: Request,
     elif kind == "image":
         if image is None:
             raise HTTPException(status_code=422, detail="Missing 'image' for kind=image")
-        import tempfile
         try:
             from AppKit import NSPasteboard, NSImage
             from Foundation import NSData
         except Exception:
             raise HTTPException(status_code=500, detail="PyObjC needed for image clipboard (pip install pyobjc)")
 
-        suffix = os.path.splitext(image.filename or "clip.png")[1] or ".png"
-        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tf:
-            while True:
-                chunk = await image.read(1024 * 1024)
-                if not chunk:
-                    break
-                tf.write(chunk)
-            tmp_path = tf.name
+        buf = bytearray()
+        while chunk := await image.read(UPLOAD_CHUNK_BYTES):
+            buf += chunk
         try:
             pb = NSPasteboard.generalPasteboard()
-            data = NSData.dataWithContentsOfFile_(tmp_path)
+            data = NSData.dataWithBytes_length_(buf, len(buf)) if buf else None
             if data is None:
                 raise RuntimeError("No image data")
             img = NSImage.alloc().initWithData_(data)
@@ -281,11 +289,7 @@ async def clip_push(request: Request,
             if not ok:
                 raise RuntimeError("Pasteboard write failed")
         except Exception as e:
-            try: os.unlink(tmp_path)
-            except Exception: pass
             raise HTTPException(status_code=500, detail=f"Failed to set clipboard image: {e}")
-        try: os.unlink(tmp_path)
-        except Exception: pass
 
         notify("Clipboard updated", "Image from device", icon_path=ICON_PATH)
         return {"ok": True, "kind": "image"}